@@ -0,0 +1,155 @@
+"""
+Recall/latency sweep for the shoe collection's HNSW index.
+
+Copies the persisted collection into in-memory collections built with each
+ef_search value, runs text queries at each over-fetch factor and compares
+against an exact scan:
+  - vec_recall:   share of the exact vector top_k present in the ANN candidates
+  - final_recall: overlap of the hybrid (vector + metadata) top_k computed from
+                  the ANN candidates vs. from the whole collection
+
+    python ann_sweep.py --ef 10,50,100,200 --overfetch 1,2,4,8 --top_k 5
+"""
+import argparse
+import json
+import time
+
+import chromadb
+import numpy as np
+
+from config import settings
+from utils import db_utils, vs_utils
+
+DEFAULT_QUERIES = [
+    "spor ayakkabı",
+    "siyah bot",
+    "düğün için taşlı topuklu",
+    "beyaz spor ayakkabı",
+    "ofis için kahverengi formal ayakkabı",
+    "kışlık su geçirmez bot",
+    "yazlık rahat günlük ayakkabı",
+    "kırmızı abiye topuklu",
+    "parlak gece ayakkabısı",
+    "mavi rahat sneaker",
+]
+
+
+def _distance(cos: np.ndarray, space: str) -> np.ndarray:
+    return 2.0 - 2.0 * cos if space == "l2" else 1.0 - cos
+
+
+def _hybrid_top_k(query: str, candidates: list, dists: dict, records: dict, top_k: int,
+                  space: str, weight_vector: float = 0.5) -> list:
+    """Same ranking as vs_utils.vector_search_shoes, restricted to the given candidate ids."""
+    tokens = vs_utils._query_tokens(query)
+    scored = []
+    for _id in candidates:
+        meta, doc = records[_id]
+        vs = vs_utils._vec_score_from_distance(dists[_id], space)
+        ms = vs_utils._meta_score(tokens, vs_utils._meta_blob(meta, doc))
+        scored.append((weight_vector * vs + (1.0 - weight_vector) * ms, _id))
+    return [_id for _, _id in sorted(scored, key=lambda x: (-x[0], str(x[1])))[:top_k]]
+
+
+def load_records():
+    client = db_utils.get_chroma_client()
+    col = db_utils.get_shoe_collection(client) if client else None
+    if col is None:
+        return None
+    data = col.get(include=["embeddings", "metadatas", "documents"])
+    embs = np.asarray(data["embeddings"], dtype=np.float32)
+    embs = embs / np.maximum(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12)
+    return data["ids"], embs, [m or {} for m in data["metadatas"]], data["documents"]
+
+
+def build_index(ids: list, embs: np.ndarray, ef_search: int, batch_size: int = 256):
+    client = chromadb.EphemeralClient()
+    metadata = {**settings.shoe_collection_metadata, "hnsw:search_ef": ef_search}
+    col = client.create_collection(name=f"sweep_ef_{ef_search}", metadata=metadata)
+    for start in range(0, len(ids), batch_size):
+        col.add(ids=ids[start:start + batch_size], embeddings=embs[start:start + batch_size].tolist())
+    return client, col
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HNSW ef_search / over-fetch recall and latency sweep")
+    parser.add_argument("--ef", type=lambda s: [int(x) for x in s.split(",")], default=[10, 25, 50, 100, 200])
+    parser.add_argument("--overfetch", type=lambda s: [int(x) for x in s.split(",")], default=[1, 2, 4, 8])
+    parser.add_argument("--top_k", type=int, default=5)
+    parser.add_argument("--queries", type=str, help="File with one query per line")
+    parser.add_argument("--target_recall", type=float, default=0.95, help="final_recall needed for a recommendation")
+    parser.add_argument("--json", type=str, help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    loaded = load_records()
+    if loaded is None or not loaded[0]:
+        print("No records found in the collection.")
+        return
+    ids, embs, metas, docs = loaded
+    records = {_id: (m, d) for _id, m, d in zip(ids, metas, docs)}
+    space = settings.vector_space
+
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries, "r") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    q_embs = [vs_utils.get_clip_text_embedding(vs_utils.enrich_shoe_query(q)) for q in queries]
+
+    top_k = min(args.top_k, len(ids))
+    exact, medians, tops = [], [], []
+    for q, e in zip(queries, q_embs):
+        cos = embs @ np.asarray(e, dtype=np.float32)
+        medians.append(float(np.median(cos)))
+        tops.append(float(cos.max()))
+        dist = _distance(cos, space)
+        dists = dict(zip(ids, dist.tolist()))
+        vec_top = [ids[i] for i in np.argsort(dist)[:top_k]]
+        exact.append((set(vec_top), set(_hybrid_top_k(q, ids, dists, records, top_k, space))))
+
+    print(f"records={len(ids)} queries={len(queries)} space={space} M={settings.hnsw_m} "
+          f"construction_ef={settings.hnsw_construction_ef} top_k={top_k}")
+    print(f"text->image cosine: median {np.median(medians):.3f}, top-1 median {np.median(tops):.3f} "
+          f"(VECTOR_SCORE_COS_LOW={settings.vector_score_cos_low} VECTOR_SCORE_COS_HIGH={settings.vector_score_cos_high})")
+    print(f"{'ef':>5} {'fetch':>5} {'vec_recall':>10} {'final_recall':>12} {'p50 ms':>8} {'p95 ms':>8}")
+    results = []
+    for ef in args.ef:
+        client, col = build_index(ids, embs, ef)
+        for factor in args.overfetch:
+            n = min(len(ids), top_k * factor)
+            vec_hits, final_hits, latencies = 0, 0, []
+            for q, e, (vec_truth, final_truth) in zip(queries, q_embs, exact):
+                t0 = time.perf_counter()
+                res = col.query(query_embeddings=[e], n_results=n, include=["distances"])
+                latencies.append((time.perf_counter() - t0) * 1000)
+                cand = res["ids"][0]
+                dists = dict(zip(cand, res["distances"][0]))
+                vec_hits += len(vec_truth & set(cand))
+                final_hits += len(final_truth & set(_hybrid_top_k(q, cand, dists, records, top_k, space)))
+            total = top_k * len(queries)
+            row = {
+                "ef_search": ef,
+                "overfetch": factor,
+                "vec_recall": vec_hits / total,
+                "final_recall": final_hits / total,
+                "latency_p50_ms": float(np.percentile(latencies, 50)),
+                "latency_p95_ms": float(np.percentile(latencies, 95)),
+            }
+            results.append(row)
+            print(f"{ef:>5} {factor:>5} {row['vec_recall']:>10.3f} {row['final_recall']:>12.3f} "
+                  f"{row['latency_p50_ms']:>8.2f} {row['latency_p95_ms']:>8.2f}")
+        client.delete_collection(col.name)
+
+    ok = [r for r in results if r["final_recall"] >= args.target_recall]
+    if ok:
+        best = min(ok, key=lambda r: (r["latency_p95_ms"], r["overfetch"], r["ef_search"]))
+        print(f"\nRecommended: HNSW_SEARCH_EF={best['ef_search']} SEARCH_OVERFETCH={best['overfetch']} "
+              f"(final_recall {best['final_recall']:.3f}, p95 {best['latency_p95_ms']:.2f} ms)")
+    else:
+        print(f"\nNo setting reached final_recall >= {args.target_recall}.")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
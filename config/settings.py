@@ -7,6 +7,8 @@ openai_endpoint = os.getenv('AZURE_OPENAI_ENDPOINT')
 openai_key = os.getenv('AZURE_OPENAI_KEY')
 accuwather_key = os.getenv('ACCUWEATHER_API_KEY')
 weather_api_key = os.getenv('OPENWEATHER_API_KEY')  
+accuweather_base_url = os.getenv('ACCUWEATHER_BASE_URL', 'http://dataservice.accuweather.com')
+openweather_base_url = os.getenv('OPENWEATHER_BASE_URL', 'http://api.openweathermap.org')
 
 extract_shoe_intent_prompt = """
 "Kullanıcı ayakkabı talebini analiz et ve JSON döndür. Alanlar: "
@@ -34,4 +36,44 @@ ARAMA STRATEJISİ:
 SADECE veritabanındaki gerçek ürünleri göster. 
 
 KONUŞMA TARZI: Dostane, profesyonel ve yardımsever. İlgili bir satış danışmanı gibi "Size özel seçtim..." gibi kişisel dokunuşlar ekle.
-'''
\ No newline at end of file
+'''
+
+llm_requests_per_minute = int(os.getenv('LLM_REQUESTS_PER_MINUTE', '60'))
+llm_tokens_per_minute = int(os.getenv('LLM_TOKENS_PER_MINUTE', '60000'))
+llm_max_retries = int(os.getenv('LLM_MAX_RETRIES', '4'))
+llm_backoff_base = float(os.getenv('LLM_BACKOFF_BASE', '1.0'))
+llm_backoff_max = float(os.getenv('LLM_BACKOFF_MAX', '30.0'))
+llm_max_queue_wait = float(os.getenv('LLM_MAX_QUEUE_WAIT', '20.0'))
+llm_batch_reserve = float(os.getenv('LLM_BATCH_RESERVE', '0.2'))
+llm_indexer_share = float(os.getenv('LLM_INDEXER_SHARE', '0.3'))  # of RPM/TPM, for the index_shoes.py process
+llm_breaker_failure_threshold = int(os.getenv('LLM_BREAKER_FAILURE_THRESHOLD', '5'))
+llm_breaker_reset_seconds = float(os.getenv('LLM_BREAKER_RESET_SECONDS', '30.0'))
+
+dedupe_cosine_threshold = float(os.getenv('DEDUPE_COSINE_THRESHOLD', '0.95'))
+dedupe_neighbours = int(os.getenv('DEDUPE_NEIGHBOURS', '5'))
+
+image_crop_to_product = os.getenv('IMAGE_CROP_TO_PRODUCT', 'true').lower() == 'true'
+image_max_side = int(os.getenv('IMAGE_MAX_SIDE', '768'))
+image_jpeg_quality = int(os.getenv('IMAGE_JPEG_QUALITY', '85'))
+image_min_jpeg_quality = int(os.getenv('IMAGE_MIN_JPEG_QUALITY', '50'))
+image_max_bytes = int(os.getenv('IMAGE_MAX_BYTES', '150000'))
+image_detail = os.getenv('IMAGE_DETAIL', 'auto')  # low | high | auto (low when the processed image is <= 512px)
+
+vector_space = os.getenv('VECTOR_SPACE', 'cosine')  # cosine | l2 | ip
+hnsw_m = int(os.getenv('HNSW_M', '16'))
+hnsw_construction_ef = int(os.getenv('HNSW_CONSTRUCTION_EF', '200'))
+hnsw_search_ef = int(os.getenv('HNSW_SEARCH_EF', '100'))
+search_overfetch = int(os.getenv('SEARCH_OVERFETCH', '8'))
+# CLIP text->image cosines sit in a narrow band; these bounds map it onto the [0,1] vector score.
+vector_score_cos_low = float(os.getenv('VECTOR_SCORE_COS_LOW', '0.15'))
+vector_score_cos_high = float(os.getenv('VECTOR_SCORE_COS_HIGH', '0.40'))
+
+shoe_collection_name = "shoe_images"
+shoe_collection_metadata = {
+    "hnsw:space": vector_space,
+    "hnsw:M": hnsw_m,
+    "hnsw:construction_ef": hnsw_construction_ef,
+    "hnsw:search_ef": hnsw_search_ef,
+    # Set only on collections created or migrated with unit-normalised CLIP vectors.
+    "embeddings:normalized": True,
+}
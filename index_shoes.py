@@ -1,10 +1,12 @@
 from utils import vs_utils
+from utils.llm_gateway import use_indexer_budget
 
 def main():
     """Main indexing function."""
     print("Simple Indexer")
     print("=" * 40)
     
+    use_indexer_budget()
     shoe_image_links = vs_utils.get_shoe_image_links()
     print(f"Processing {len(shoe_image_links)} shoe images...")
     
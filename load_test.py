@@ -0,0 +1,307 @@
+"""
+Local load test: drives N simulated shoppers through the real Chainlit
+on_chat_start / on_message handlers against stub OpenAI and weather servers.
+
+    python load_test.py --levels 1,5,10,25 --duration 30
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FOLLOW_UPS = [
+    "Siyah olanı var mı?",
+    "Daha rahat bir alternatif önerir misin?",
+    "İstanbul'da hava nasıl, bot mu giymeliyim?",
+    "Beyaz spor ayakkabı göster",
+    "Düğün için taşlı topuklu arıyorum",
+    "Ofiste tüm gün giyebileceğim kahverengi bir ayakkabı",
+    "Yazlık, hafif ve günlük kullanım için ne önerirsin?",
+    "Ankara'da bu hafta kar var mı? Kışlık bot lazım",
+    "Kırmızı abiye ile ne uyar?",
+    "Bunların içinde en şık olanı hangisi?",
+]
+
+# Handlers return canned text instead of raising; these markers mean the turn failed.
+APOLOGY_REPLIES = ("I apologize, but I encountered an error", "Üzgünüm, şu anda teknik bir sorun")
+TOOL_ERRORS = {
+    "vector_search_shoes": ("search_error", ("geçici bir sorun",)),
+    "get_current_weather": ("weather_error", ("hata oluştu", "alınamadı")),
+}
+
+
+def _stub_openai_reply(body: dict) -> dict:
+    messages = body.get("messages", [])
+    last = messages[-1] if messages else {}
+    user_text = next((m.get("content") for m in reversed(messages)
+                      if m.get("role") == "user" and isinstance(m.get("content"), str)), "")
+    message = {"role": "assistant", "content": None}
+    finish = "stop"
+    if (body.get("response_format") or {}).get("type") == "json_object":
+        message["content"] = json.dumps({"query": user_text, "shoe_type": "ayakkabı", "special_features": []})
+    elif last.get("role") == "tool" or not body.get("tools"):
+        message["content"] = "Size özel seçtiğim ayakkabılar bulundu! Hangisi ilginizi çekti?"
+    else:
+        lowered = user_text.lower()
+        if "hava" in lowered or "kar " in lowered:
+            name, args = "get_weather", {"city": "İstanbul"}
+        elif len(user_text) > 80:
+            name, args = "plan_and_search", {"user_request": user_text}
+        else:
+            name, args = "search_shoes", {"query": user_text}
+        message["tool_calls"] = [{
+            "id": f"call_{uuid.uuid4().hex[:12]}",
+            "type": "function",
+            "function": {"name": name, "arguments": json.dumps(args, ensure_ascii=False)},
+        }]
+        finish = "tool_calls"
+    prompt_tokens = sum(len(str(m.get("content") or "")) for m in messages) // 4
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o"),
+        "choices": [{"index": 0, "message": message, "finish_reason": finish}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 40, "total_tokens": prompt_tokens + 40},
+    }
+
+
+def _make_handler(latency: float, reply):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, payload: dict):
+            time.sleep(latency)
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            self._send(reply(body))
+
+        def do_GET(self):
+            self._send(reply({}))
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def _stub_weather_reply(_body: dict) -> dict:
+    return {
+        "weather": [{"description": "parçalı bulutlu"}],
+        "main": {"temp": 12.5, "feels_like": 10.9, "humidity": 71},
+    }
+
+
+def _serve(port: int, latency: float, kind: str):
+    reply = _stub_openai_reply if kind == "openai" else _stub_weather_reply
+    ThreadingHTTPServer(("127.0.0.1", port), _make_handler(latency, reply)).serve_forever()
+
+
+def rss_mb(pid: int = None) -> float:
+    """Current resident set size from /proc, falling back to peak RSS for this process."""
+    try:
+        with open(f"/proc/{pid or os.getpid()}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if pid is None else 0.0
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def monitor(stop: asyncio.Event, lags: list, rss: list, interval: float = 0.05):
+    """Sample event-loop lag (sleep overshoot) and RSS until stop is set."""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        t = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - t - interval))
+        rss.append(rss_mb())
+
+
+def classify_reply(cl) -> str:
+    """Return the failure kind of the turn that just finished, or "" if it succeeded."""
+    if cl.user_session.get("load_test_failure"):
+        return cl.user_session.get("load_test_failure")
+    messages = cl.user_session.get("messages") or []
+    if not messages or messages[-1].get("role") != "assistant":
+        return "no_reply"
+    content = str(messages[-1].get("content") or "")
+    return "apology" if any(m in content for m in APOLOGY_REPLIES) else ""
+
+
+def flag_failures(cl, app, vs_utils):
+    """Wrap the fallback and tool functions so a failed turn is flagged in the session."""
+    def wrap(module, name, kind, markers=None):
+        original = getattr(module, name)
+
+        def wrapper(*a, **kw):
+            result = original(*a, **kw)
+            if markers is None or any(m in str(result) for m in markers):
+                cl.user_session.set("load_test_failure", kind)
+            return result
+        setattr(module, name, wrapper)
+
+    # Callers look these up as module attributes at call time, so the wrappers see every use.
+    wrap(app, "fallback_search", "fallback")
+    for name, (kind, markers) in TOOL_ERRORS.items():
+        wrap(vs_utils, name, kind, markers)
+
+
+async def run_session(app, cl, init_http_context, prompts: list, deadline: float,
+                      think: tuple, turns: list, errors: list):
+    init_http_context(thread_id=str(uuid.uuid4()))
+    await app.on_chat_start()
+    turn = 0
+    while time.monotonic() < deadline:
+        text = prompts[turn % len(prompts)]
+        cl.user_session.set("load_test_failure", "")
+        t0 = time.perf_counter()
+        try:
+            await app.on_message(cl.Message(content=text, author="User"))
+            kind = classify_reply(cl)
+        except Exception as e:
+            kind = type(e).__name__
+        if kind:
+            errors.append(kind)
+        else:
+            turns.append((time.monotonic(), time.perf_counter() - t0))
+        turn += 1
+        pause = min(random.uniform(*think), deadline - time.monotonic())
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+
+async def run_level(app, cl, init_http_context, sessions: int, duration: float,
+                    think: tuple, starters: list, corpus: list) -> dict:
+    turns, errors, lags, rss = [], [], [], []
+    stop = asyncio.Event()
+    mon = asyncio.create_task(monitor(stop, lags, rss))
+    start = time.monotonic()
+    deadline = start + duration
+    tasks = []
+    for _ in range(sessions):
+        prompts = [random.choice(starters)] + random.sample(corpus, len(corpus))
+        tasks.append(asyncio.create_task(
+            run_session(app, cl, init_http_context, prompts, deadline, think, turns, errors)
+        ))
+        await asyncio.sleep(random.uniform(0, think[1]) / max(1, sessions))
+    await asyncio.gather(*tasks)
+    stop.set()
+    await mon
+    latencies = [lat for _, lat in turns]
+    in_window = sum(1 for done, _ in turns if done <= deadline)
+    return {
+        "sessions": sessions,
+        "turns": len(turns),
+        "errors": len(errors),
+        "error_kinds": dict(Counter(errors)),
+        "turns_per_s": in_window / duration if duration else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": max(latencies, default=0.0),
+        "loop_lag_p99": percentile(lags, 99),
+        "loop_lag_max": max(lags, default=0.0),
+        "rss_peak_mb": max(rss, default=rss_mb()),
+    }
+
+
+async def run(args, stub_pids: dict) -> list:
+    # Imported here so the stub endpoints in os.environ are picked up by config.settings.
+    import chainlit as cl
+    from chainlit.context import init_http_context
+    import main as app
+
+    from utils import vs_utils
+
+    flag_failures(cl, app, vs_utils)
+
+    init_http_context(thread_id=str(uuid.uuid4()))
+    starters = [s.message for s in await app.set_starts()]
+    corpus = FOLLOW_UPS
+    if args.corpus:
+        with open(args.corpus, "r") as f:
+            corpus = [line.strip() for line in f if line.strip()]
+
+    results = []
+    for level in args.levels:
+        r = await run_level(app, cl, init_http_context, level, args.duration,
+                            (args.think_min, args.think_max), starters, corpus)
+        r.update({f"rss_{name}_mb": rss_mb(pid) for name, pid in stub_pids.items()})
+        results.append(r)
+        print(
+            f"{r['sessions']:>8} {r['turns']:>6} {r['errors']:>6} {r['turns_per_s']:>8.2f} "
+            f"{r['latency_p50']:>7.2f} {r['latency_p95']:>7.2f} {r['latency_p99']:>7.2f} "
+            f"{r['loop_lag_p99'] * 1000:>9.1f} {r['loop_lag_max'] * 1000:>9.1f} {r['rss_peak_mb']:>8.1f}"
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent Chainlit session load test")
+    parser.add_argument("--levels", type=lambda s: [int(x) for x in s.split(",")], default=[1, 5, 10, 25],
+                        help="Comma separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds per concurrency level")
+    parser.add_argument("--think-min", type=float, default=1.0, help="Min think time between turns (s)")
+    parser.add_argument("--think-max", type=float, default=4.0, help="Max think time between turns (s)")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Stub OpenAI response latency (s)")
+    parser.add_argument("--weather-latency", type=float, default=0.05, help="Stub weather response latency (s)")
+    parser.add_argument("--openai-port", type=int, default=8765)
+    parser.add_argument("--weather-port", type=int, default=8766)
+    parser.add_argument("--corpus", type=str, help="File with one follow-up message per line")
+    parser.add_argument("--json", type=str, help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    stubs = {
+        "openai_stub": multiprocessing.Process(
+            target=_serve, args=(args.openai_port, args.llm_latency, "openai"), daemon=True),
+        "weather_stub": multiprocessing.Process(
+            target=_serve, args=(args.weather_port, args.weather_latency, "weather"), daemon=True),
+    }
+    for p in stubs.values():
+        p.start()
+    time.sleep(0.5)
+
+    os.environ["AZURE_OPENAI_ENDPOINT"] = f"http://127.0.0.1:{args.openai_port}"
+    os.environ["AZURE_OPENAI_KEY"] = "stub"
+    os.environ["ACCUWEATHER_API_KEY"] = ""
+    os.environ["OPENWEATHER_API_KEY"] = "stub"
+    os.environ["OPENWEATHER_BASE_URL"] = f"http://127.0.0.1:{args.weather_port}"
+    os.environ.setdefault("LLM_REQUESTS_PER_MINUTE", "100000")
+    os.environ.setdefault("LLM_TOKENS_PER_MINUTE", "100000000")
+
+    print(f"{'sessions':>8} {'turns':>6} {'errors':>6} {'turns/s':>8} "
+          f"{'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'lag99 ms':>9} {'lagmax ms':>9} {'rss MB':>8}")
+    try:
+        results = asyncio.run(run(args, {name: p.pid for name, p in stubs.items()}))
+    finally:
+        for p in stubs.values():
+            p.terminate()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,9 @@
 import json
 import chainlit as cl
 from typing import Optional, List
-from openai import AzureOpenAI
 from config import settings 
 from utils import vs_utils
+from utils.llm_gateway import gateway, LLMUnavailableError
 
 @cl.step(type="tool")
 async def search_shoes(query: str) -> str:
@@ -91,16 +91,18 @@ tools = [
         }
     ]
 
-client = AzureOpenAI(
-    api_key=settings.openai_key,
-    api_version="2024-02-15-preview",
-    azure_endpoint=settings.openai_endpoint,
-    default_headers={"Ocp-Apim-Subscription-Key": settings.openai_key}
-)
+def fallback_search(messages, tool_results: List[str]) -> str:
+    """Answer without the LLM: reuse finished tool output or run a plain vector search."""
+    if tool_results:
+        return "\n\n".join(tool_results)
+    user_text = next((m["content"] for m in reversed(messages)
+                      if isinstance(m, dict) and m.get("role") == "user"), "")
+    return vs_utils.vector_search_shoes(user_text, 5)
 
 async def call_azure_openai(messages):
+    tool_results = []
     try:
-        response = client.chat.completions.create(
+        response = await gateway.achat(
             model="gpt-4o",
             messages=messages,
             stream=False,
@@ -127,6 +129,7 @@ async def call_azure_openai(messages):
                     tool_result = await plan_and_search(function_args["user_request"])
                 else:
                     tool_result = f"Tool {function_name} not found"
+                tool_results.append(str(tool_result))
                 
                 messages.append({
                     "role": "assistant",
@@ -139,7 +142,7 @@ async def call_azure_openai(messages):
                     "content": str(tool_result)
                 })
             
-            final_response = client.chat.completions.create(
+            final_response = await gateway.achat(
                 model="gpt-4o",
                 messages=messages,
                 stream=False,
@@ -155,6 +158,9 @@ async def call_azure_openai(messages):
         
         return message.content
 
+    except LLMUnavailableError as e:
+        print(f"Azure OpenAI unavailable, falling back to direct search: {e}")
+        return fallback_search(messages, tool_results)
     except Exception as e:
         print(f"Error calling Azure OpenAI: {str(e)}")
         return "I apologize, but I encountered an error. Please try again."
@@ -1,12 +1,18 @@
 import clip
 import torch, random, numpy as np
 from chromadb import PersistentClient
+from config import settings
+from utils.db_utils import warn_if_unmigrated
 
 clip_model, clip_preprocess = clip.load("ViT-B/32")
 chroma_client = PersistentClient(path="./chroma_db")
 
 def get_shoe_collection():
-    return chroma_client.get_or_create_collection(name="shoe_images")
+    col = chroma_client.get_or_create_collection(
+        name=settings.shoe_collection_name, metadata=settings.shoe_collection_metadata
+    )
+    warn_if_unmigrated(col)
+    return col
 
 def get_hotel_collection():
     return get_shoe_collection()
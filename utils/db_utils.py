@@ -1,7 +1,9 @@
 import argparse
 import json
+import numpy as np
 from typing import Optional, Dict, Any
 from chromadb import PersistentClient
+from config import settings
 
 def get_chroma_client():
     """
@@ -15,12 +17,40 @@ def get_chroma_client():
         return None
 
 
+_warned_unmigrated = set()
+
+
+def requires_migration(collection) -> bool:
+    """
+    True when the stored vectors cannot be compared with the normalised query vectors:
+    a legacy collection with raw CLIP embeddings, or one built in another distance space.
+    """
+    meta = collection.metadata or {}
+    return not meta.get("embeddings:normalized") or meta.get("hnsw:space", "l2") != settings.vector_space
+
+
+def warn_if_unmigrated(collection):
+    """Print once per process when the collection differs from config.settings."""
+    meta = collection.metadata or {}
+    issues = [f"{k}={meta.get(k)!r} (expected {v!r})"
+              for k, v in settings.shoe_collection_metadata.items() if meta.get(k) != v]
+    if not issues or collection.name in _warned_unmigrated:
+        return
+    _warned_unmigrated.add(collection.name)
+    level = "ERROR" if requires_migration(collection) else "WARNING"
+    print(f"{level}: collection {collection.name} does not match config.settings: {', '.join(issues)}. "
+          f"Run `python -m utils.db_utils --migrate` before indexing, --dedupe or serving search.")
+
+
 def get_shoe_collection(client):
     """
     Get the shoe collection from the ChromaDB client. If it doesn't exist, create it.
     """
     try:
-        collection = client.get_or_create_collection(name="shoe_images")
+        collection = client.get_or_create_collection(
+            name=settings.shoe_collection_name, metadata=settings.shoe_collection_metadata
+        )
+        warn_if_unmigrated(collection)
         return collection
     except Exception as e:
         print(f"Error getting or creating shoe collection: {e}")
@@ -115,6 +145,102 @@ def search_vector(collection, query: str, top_k: int = 5):
         print(f"Error running vector search: {e}")
 
 
+def _copy_records(src, dst, batch_size: int = 256, skip_existing: bool = False):
+    """Copy every record from src to dst, L2-normalising embeddings on the way."""
+    offset, copied = 0, 0
+    while True:
+        batch = src.get(include=["embeddings", "metadatas", "documents"], limit=batch_size, offset=offset)
+        ids = batch.get("ids", [])
+        if not ids:
+            return copied
+        offset += len(ids)
+        keep = list(range(len(ids)))
+        if skip_existing:
+            existing = set(dst.get(ids=ids, include=[])["ids"])
+            keep = [i for i in keep if ids[i] not in existing]
+            if not keep:
+                continue
+        embs = np.asarray([batch["embeddings"][i] for i in keep], dtype=np.float32)
+        embs = embs / np.maximum(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12)
+        dst.add(
+            ids=[ids[i] for i in keep],
+            embeddings=embs.tolist(),
+            metadatas=[batch["metadatas"][i] for i in keep],
+            documents=[batch["documents"][i] for i in keep],
+        )
+        copied += len(keep)
+
+
+def _collection_names(client) -> set:
+    return {getattr(c, "name", c) for c in client.list_collections()}
+
+
+def migrate_collection(client, batch_size: int = 256):
+    """
+    Rebuild the shoe collection in place with the space and HNSW parameters from
+    config.settings. Records go through a staging collection whose metadata tracks
+    the phase ("copying" -> "staged" -> "rebuilding") and the source record count:
+    - copying: the live collection is untouched, so staging is discarded and redone
+    - staged: resumed if the live collection is gone or still has source_count records
+    - rebuilding: the live collection was already being replaced; records indexed
+      into it since then are folded into staging before the rebuild continues
+    """
+    name = settings.shoe_collection_name
+    staging_name = f"{name}__migrate"
+    try:
+        names = _collection_names(client)
+        staging = client.get_collection(staging_name) if staging_name in names else None
+        staging_meta = (staging.metadata or {}) if staging is not None else {}
+        phase = staging_meta.get("migrate:phase")
+        # With no live collection the staging copy is the only one left, so always resume from it.
+        if phase == "staged" and name in names and (
+            client.get_collection(name).count() != staging_meta.get("migrate:source_count")
+        ):
+            print(f"{name} changed since the interrupted migration was staged, restaging.")
+            phase = None
+        if staging is not None and phase not in ("staged", "rebuilding"):
+            client.delete_collection(staging_name)
+            staging = None
+        if staging is None:
+            if name not in names:
+                print(f"Collection {name} does not exist, nothing to migrate.")
+                return
+            source = client.get_collection(name)
+            print(f"Current metadata: {source.metadata}")
+            staging = client.create_collection(
+                name=staging_name, metadata={"migrate:source": name, "migrate:phase": "copying"}
+            )
+            staged = _copy_records(source, staging, batch_size)
+            staging_meta = {"migrate:source": name, "migrate:phase": "staged", "migrate:source_count": staged}
+            staging.modify(metadata=staging_meta)
+            print(f"Staged {staged} records.")
+        else:
+            print(f"Resuming migration from {staging_name} ({phase}).")
+
+        live_exists = name in _collection_names(client)
+        if live_exists and phase == "rebuilding":
+            added = _copy_records(client.get_collection(name), staging, batch_size, skip_existing=True)
+            print(f"Kept {added} records indexed since the interrupted run.")
+        staging.modify(metadata={**staging_meta, "migrate:phase": "rebuilding"})
+        if live_exists:
+            client.delete_collection(name)
+        target = client.create_collection(name=name, metadata=settings.shoe_collection_metadata)
+        copied = _copy_records(staging, target, batch_size)
+        client.delete_collection(staging_name)
+        print(f"Migrated {copied} records. New metadata: {target.metadata}")
+    except Exception as e:
+        print(f"Error migrating collection: {e}")
+
+
+def dedupe_collection(threshold: Optional[float] = None, prune: bool = False):
+    """Proxy to vs_utils.cluster_near_duplicates."""
+    try:
+        from utils import vs_utils
+        vs_utils.cluster_near_duplicates(threshold=threshold, prune=prune)
+    except Exception as e:
+        print(f"Error clustering duplicates: {e}")
+
+
 def main():
     parser = argparse.ArgumentParser(description="ChromaDB Shoe Collection Utilities")
     group = parser.add_mutually_exclusive_group(required=False)
@@ -123,16 +249,23 @@ def main():
     group.add_argument("--head", type=int, help="Show first N records")
     group.add_argument("--filter", type=str, help="Filter with JSON where clause, e.g. '{\"shoe_type\": \"spor\"}'")
     group.add_argument("--search", type=str, help="Vector search with natural language query")
+    group.add_argument("--dedupe", action="store_true", help="Cluster near-duplicate images and assign canonical_id")
+    group.add_argument("--migrate", action="store_true", help="Rebuild the collection with the configured space/HNSW settings")
     parser.add_argument("--top_k", type=int, default=5, help="Top K for vector search")
     parser.add_argument("--limit", type=int, help="Limit number of records printed for list/filter")
+    parser.add_argument("--threshold", type=float, help="Cosine similarity threshold for --dedupe")
+    parser.add_argument("--prune", action="store_true", help="With --dedupe, delete non-canonical copies")
 
     args = parser.parse_args()
-    if not (args.count or args.list or args.head is not None or args.filter or args.search):
+    if not (args.count or args.list or args.head is not None or args.filter or args.search or args.dedupe or args.migrate):
         args.count = True
 
     client = get_chroma_client()
     if client is None:
         return
+    if args.migrate:
+        migrate_collection(client)
+        return
     collection = get_shoe_collection(client)
     if collection is None:
         return
@@ -154,6 +287,8 @@ def main():
             print(f"Invalid JSON for --filter: {e}")
     elif args.search:
         search_vector(collection, args.search, top_k=args.top_k)
+    elif args.dedupe:
+        dedupe_collection(threshold=args.threshold, prune=args.prune)
 
 if __name__ == "__main__":
     main()
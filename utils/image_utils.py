@@ -1,18 +1,91 @@
+import math
 import requests
-from PIL import Image
+from PIL import Image, ImageChops
 from io import BytesIO
 import base64
+from typing import Optional
+from config import settings
 
-def get_base64_image_from_url(image_url: str):
+
+def crop_to_product(img: Image.Image, tolerance: int = 20, margin: float = 0.02) -> Image.Image:
+    """Crop away the flat studio background, using the top-left pixel as the background colour."""
+    bg = Image.new("RGB", img.size, img.getpixel((0, 0)))
+    diff = ImageChops.difference(img, bg)
+    diff = ImageChops.add(diff, diff, 2.0, -tolerance)
+    bbox = diff.getbbox()
+    if not bbox:
+        return img
+    pad_x, pad_y = int(img.width * margin), int(img.height * margin)
+    left, top, right, bottom = bbox
+    return img.crop((
+        max(0, left - pad_x), max(0, top - pad_y),
+        min(img.width, right + pad_x), min(img.height, bottom + pad_y),
+    ))
+
+
+def pick_detail(width: int, height: int) -> str:
+    """Use the configured detail, or for "auto" send low detail when the image fits a single 512px tile."""
+    if settings.image_detail in ("low", "high"):
+        return settings.image_detail
+    return "low" if max(width, height) <= 512 else "high"
+
+
+def estimate_image_tokens(width: int, height: int, detail: str) -> int:
+    """GPT-4o vision cost: 85 base tokens plus 170 per 512px tile at high detail."""
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def encode_jpeg(img: Image.Image, quality: int, min_quality: int, max_bytes: int) -> tuple[bytes, int]:
+    """Encode at the highest quality that fits max_bytes, stepping down to min_quality."""
+    while True:
+        buf = BytesIO()
+        img.save(buf, format="JPEG", quality=quality, optimize=True)
+        data = buf.getvalue()
+        if len(data) <= max_bytes or quality <= min_quality:
+            return data, quality
+        quality = max(min_quality, quality - 10)
+
+
+def prepare_image_payload(image_url: str) -> Optional[dict]:
+    """
+    Download and preprocess a product photo for vision captioning:
+    crop to the product, downsize to image_max_side, adapt JPEG quality to image_max_bytes.
+    Returns the image_url content part plus size/cost stats, or None on failure.
+    """
     try:
         r = requests.get(image_url, timeout=10)
         r.raise_for_status()
         with Image.open(BytesIO(r.content)) as img:
             if img.mode != "RGB":
                 img = img.convert("RGB")
-            buf = BytesIO()
-            img.save(buf, format="JPEG")
-        return "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode("utf-8")
+            if settings.image_crop_to_product:
+                img = crop_to_product(img)
+            img.thumbnail((settings.image_max_side, settings.image_max_side), Image.LANCZOS)
+            data, quality = encode_jpeg(
+                img, settings.image_jpeg_quality, settings.image_min_jpeg_quality, settings.image_max_bytes
+            )
+            width, height = img.size
+        detail = pick_detail(width, height)
+        return {
+            "url": "data:image/jpeg;base64," + base64.b64encode(data).decode("utf-8"),
+            "detail": detail,
+            "original_bytes": len(r.content),
+            "bytes": len(data),
+            "size": (width, height),
+            "quality": quality,
+            "estimated_tokens": estimate_image_tokens(width, height, detail),
+        }
     except Exception as e:
-        print(f"base64 error: {e}")
-        return None
\ No newline at end of file
+        print(f"image payload error: {e}")
+        return None
+
+
+def get_base64_image_from_url(image_url: str):
+    payload = prepare_image_payload(image_url)
+    return payload["url"] if payload else None
@@ -0,0 +1,319 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from openai import (
+    AzureOpenAI,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+from config import settings
+
+INTERACTIVE = 0
+BATCH = 1
+
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+
+class LLMUnavailableError(Exception):
+    """Raised when a call cannot be served: breaker open, queue timeout or retries exhausted."""
+
+
+class _Bucket:
+    def __init__(self, per_minute: int):
+        self.capacity = float(max(1, per_minute))
+        self.level = self.capacity
+        self.rate = self.capacity / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, floor: float) -> float:
+        amount = min(amount, self.capacity - floor)
+        return max(0.0, (amount + floor - self.level) / self.rate)
+
+
+class RateLimiter:
+    """
+    Token bucket over requests/minute and tokens/minute with two priority lanes.
+    Batch callers yield while interactive callers are waiting and may not dip
+    into the reserved share of either bucket.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, batch_reserve: float = 0.2):
+        self._requests = _Bucket(requests_per_minute)
+        self._tokens = _Bucket(tokens_per_minute)
+        self._reserve = max(0.0, min(0.9, batch_reserve))
+        self._cond = threading.Condition()
+        self._interactive_waiting = 0
+
+    def acquire(self, tokens: int, priority: int = INTERACTIVE, timeout: Optional[float] = None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            if priority == INTERACTIVE:
+                self._interactive_waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._requests.refill(now)
+                    self._tokens.refill(now)
+                    if priority == INTERACTIVE:
+                        blocked = False
+                        floor_r = floor_t = 0.0
+                    else:
+                        blocked = self._interactive_waiting > 0
+                        floor_r = self._reserve * self._requests.capacity
+                        floor_t = self._reserve * self._tokens.capacity
+                    wait = max(
+                        self._requests.wait_time(1, floor_r),
+                        self._tokens.wait_time(tokens, floor_t),
+                    )
+                    if not blocked and wait <= 0:
+                        self._requests.level -= 1
+                        self._tokens.level -= tokens
+                        return
+                    if blocked:
+                        wait = 0.5
+                    if deadline is not None:
+                        remaining = deadline - now
+                        if remaining <= 0 or (not blocked and wait > remaining):
+                            raise LLMUnavailableError("rate limiter queue timeout")
+                        wait = min(wait, remaining)
+                    self._cond.wait(timeout=wait)
+            finally:
+                if priority == INTERACTIVE:
+                    self._interactive_waiting -= 1
+                    self._cond.notify_all()
+
+    def reconcile(self, estimated: int, actual: int):
+        """Refund or charge the token bucket once the real usage is known."""
+        with self._cond:
+            bucket = self._tokens
+            bucket.level = min(bucket.capacity, bucket.level + estimated - actual)
+            self._cond.notify_all()
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self._state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def release_probe(self):
+        """Give back a half-open probe slot that was granted but never used."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        ms = headers.get("retry-after-ms")
+        if ms:
+            return float(ms) / 1000.0
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def estimate_tokens(messages: list, max_tokens: int = 0, image_tokens: Optional[int] = None) -> int:
+    """
+    Rough prompt + completion estimate (~4 chars per token). Images cost image_tokens each
+    when the caller knows it, else a flat 85 (low) / 765 (high) tokens.
+    """
+    total = max_tokens or 0
+    for m in messages:
+        content = m.get("content") if isinstance(m, dict) else getattr(m, "content", None)
+        total += 4
+        if isinstance(content, str):
+            total += len(content) // 4
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    total += len(part.get("text", "")) // 4
+                elif part.get("type") == "image_url":
+                    if image_tokens is not None:
+                        total += image_tokens
+                        continue
+                    detail = (part.get("image_url") or {}).get("detail", "auto")
+                    total += 85 if detail == "low" else 765
+    return total
+
+
+class LLMGateway:
+    """Single entry point for chat completions: rate limiting, retry with backoff and circuit breaking."""
+
+    def __init__(self, client, limiter: RateLimiter, breaker: CircuitBreaker,
+                 max_retries: int = 4, backoff_base: float = 1.0, backoff_max: float = 30.0,
+                 max_queue_wait: float = 20.0):
+        self.client = client
+        self.limiter = limiter
+        self.breaker = breaker
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_queue_wait = max_queue_wait
+
+    @property
+    def available(self) -> bool:
+        return self.client is not None
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        retry_after = _retry_after_seconds(error)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _is_outage(self, error: Exception) -> bool:
+        """A 429 that tells us when to come back is throttling, not an outage."""
+        return not (isinstance(error, RateLimitError) and _retry_after_seconds(error) is not None)
+
+    def chat(self, priority: int = INTERACTIVE, estimated_tokens: Optional[int] = None, **kwargs):
+        """
+        Call chat.completions.create with the given kwargs.
+        Interactive calls give up after max_queue_wait seconds so callers can fall back quickly;
+        batch calls wait as long as needed. The breaker sees one outcome per call, after retries.
+        estimated_tokens overrides the built-in estimate charged against the TPM bucket.
+        """
+        if self.client is None:
+            raise LLMUnavailableError("Azure OpenAI client is not configured")
+        if not self.breaker.allow():
+            raise LLMUnavailableError("circuit breaker open")
+        budget = self.max_queue_wait if priority == INTERACTIVE else None
+        deadline = time.monotonic() + budget if budget is not None else None
+        estimated = estimated_tokens
+        if estimated is None:
+            estimated = estimate_tokens(kwargs.get("messages", []), kwargs.get("max_tokens", 0))
+
+        # None releases a half-open probe without judging the service (queue timeout, client error).
+        outcome = None
+        try:
+            for attempt in range(self.max_retries + 1):
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                self.limiter.acquire(estimated, priority, timeout=remaining)
+                try:
+                    response = self.client.chat.completions.create(**kwargs)
+                except RETRYABLE_ERRORS as e:
+                    self.limiter.reconcile(estimated, 0)
+                    delay = self._backoff(attempt, e)
+                    print(f"LLM call failed ({type(e).__name__}), attempt {attempt + 1}/{self.max_retries + 1}")
+                    if attempt == self.max_retries:
+                        outcome = "failure" if self._is_outage(e) else None
+                        raise LLMUnavailableError(str(e)) from e
+                    if deadline is not None and time.monotonic() + delay > deadline:
+                        outcome = "failure" if self._is_outage(e) else None
+                        raise LLMUnavailableError(f"retry delay {delay:.1f}s exceeds budget") from e
+                    time.sleep(delay)
+                    continue
+                except Exception:
+                    self.limiter.reconcile(estimated, 0)
+                    raise
+                outcome = "success"
+                usage = getattr(response, "usage", None)
+                if usage is not None and getattr(usage, "total_tokens", None):
+                    self.limiter.reconcile(estimated, usage.total_tokens)
+                return response
+        finally:
+            if outcome == "success":
+                self.breaker.record_success()
+            elif outcome == "failure":
+                self.breaker.record_failure()
+            else:
+                self.breaker.release_probe()
+
+    async def achat(self, priority: int = INTERACTIVE, estimated_tokens: Optional[int] = None, **kwargs):
+        """chat() for async handlers: queueing and backoff run in a worker thread, not on the event loop."""
+        return await asyncio.to_thread(self.chat, priority, estimated_tokens, **kwargs)
+
+
+try:
+    client = AzureOpenAI(
+        api_key=settings.openai_key,
+        api_version="2024-02-15-preview",
+        azure_endpoint=settings.openai_endpoint,
+        default_headers={"Ocp-Apim-Subscription-Key": settings.openai_key},
+        max_retries=0,
+    )
+except Exception as e:
+    print(f"Azure OpenAI init error: {e}")
+    client = None
+
+def _limiter(share: float) -> RateLimiter:
+    share = max(0.0, min(1.0, share))
+    return RateLimiter(
+        int(settings.llm_requests_per_minute * share),
+        int(settings.llm_tokens_per_minute * share),
+        settings.llm_batch_reserve,
+    )
+
+
+# Limiters are per process. The chat app keeps (1 - llm_indexer_share) of the deployment's
+# RPM/TPM and index_shoes.py switches to the remaining share, so the two processes together
+# stay under the quota and indexing can never eat into chat's budget.
+gateway = LLMGateway(
+    client,
+    _limiter(1.0 - settings.llm_indexer_share),
+    CircuitBreaker(settings.llm_breaker_failure_threshold, settings.llm_breaker_reset_seconds),
+    max_retries=settings.llm_max_retries,
+    backoff_base=settings.llm_backoff_base,
+    backoff_max=settings.llm_backoff_max,
+    max_queue_wait=settings.llm_max_queue_wait,
+)
+
+
+def use_indexer_budget():
+    """Switch this process's limiter to the indexer share of RPM/TPM."""
+    gateway.limiter = _limiter(settings.llm_indexer_share)
@@ -4,30 +4,21 @@ from io import BytesIO
 import base64
 import json
 import torch
+import numpy as np
 from service.service_orchestrator import clip_model, clip_preprocess, get_shoe_collection
 from config import settings
-from openai import AzureOpenAI
 import re
-from utils.image_utils import get_base64_image_from_url
-
-try:
-    azure_client = AzureOpenAI(
-        api_key=settings.openai_key,
-        api_version="2024-02-15-preview",
-        azure_endpoint=settings.openai_endpoint,
-        default_headers={"Ocp-Apim-Subscription-Key": settings.openai_key}
-    )
-except Exception as e:
-    print(f"Azure OpenAI init error: {e}")
-    azure_client = None
+from utils.image_utils import prepare_image_payload
+from utils.llm_gateway import gateway, BATCH, estimate_tokens
+from utils.db_utils import requires_migration
 
 
 async def extract_shoe_intent(user_query: str):
-    if not azure_client:
+    if not gateway.available:
         return {"query": user_query}
     try:
         system_content = settings.extract_shoe_intent_prompt
-        resp = azure_client.chat.completions.create(
+        resp = await gateway.achat(
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": system_content},
@@ -43,31 +34,161 @@ async def extract_shoe_intent(user_query: str):
         return {"query": user_query}
 
 
+def _l2_normalize(v) -> list:
+    v = np.asarray(v, dtype=np.float32).flatten()
+    n = float(np.linalg.norm(v))
+    return (v / n if n else v).tolist()
+
+
 def get_clip_image_embedding(image_url: str):
     r = requests.get(image_url, timeout=10)
     r.raise_for_status()
     image = Image.open(BytesIO(r.content)).convert("RGB")
     image_input = clip_preprocess(image).unsqueeze(0)
     with torch.no_grad():
-        emb = clip_model.encode_image(image_input).cpu().numpy().flatten().tolist()
-    return emb
+        emb = clip_model.encode_image(image_input).cpu().numpy()
+    return _l2_normalize(emb)
 
 
 def get_clip_text_embedding(text: str):
     import clip
     tokens = clip.tokenize([text])
     with torch.no_grad():
-        emb = clip_model.encode_text(tokens).cpu().numpy().flatten().tolist()
-    return emb
+        emb = clip_model.encode_text(tokens).cpu().numpy()
+    return _l2_normalize(emb)
 
 
-def insert_to_vector_db(image_url: str, json_data: dict, description: str):
+def insert_to_vector_db(image_url: str, json_data: dict, description: str, emb: list = None):
     col = get_shoe_collection()
-    emb = get_clip_image_embedding(image_url)
-    meta = {**json_data, "image_url": image_url}
+    if emb is None:
+        emb = get_clip_image_embedding(image_url)
+    meta = {**json_data, "image_url": image_url, "canonical_id": image_url}
     col.add(documents=[description], embeddings=[emb], ids=[image_url], metadatas=[meta])
 
 
+def _cosine(a, b) -> float:
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    denom = float(np.linalg.norm(a) * np.linalg.norm(b))
+    return float(a @ b) / denom if denom else 0.0
+
+
+def find_near_duplicate(col, emb: list, threshold: float = None):
+    """
+    Look up the nearest indexed products (HNSW, no all-pairs scan). If the closest one's cosine
+    similarity is >= threshold, return (id, metadata) of the canonical record it belongs to, else None.
+    """
+    threshold = settings.dedupe_cosine_threshold if threshold is None else threshold
+    count = col.count()
+    if count == 0:
+        return None
+    res = col.query(
+        query_embeddings=[emb],
+        n_results=min(settings.dedupe_neighbours, count),
+        include=["embeddings", "metadatas"],
+    )
+    best = None
+    for _id, e, m in zip(res["ids"][0], res["embeddings"][0], res["metadatas"][0]):
+        sim = _cosine(emb, e)
+        if sim >= threshold and (best is None or sim > best[0]):
+            best = (sim, _id, m or {})
+    if best is None:
+        return None
+    _, _id, meta = best
+    canonical_id = meta.get("canonical_id") or _id
+    if canonical_id != _id:
+        got = col.get(ids=[canonical_id], include=["metadatas"])
+        if got["ids"]:
+            return canonical_id, got["metadatas"][0] or {}
+    return _id, meta
+
+
+def register_duplicate(col, canonical_id: str, meta: dict, image_url: str):
+    """Record image_url as another copy of canonical_id instead of adding a new vector."""
+    urls = json.loads(meta.get("duplicate_urls") or "[]")
+    if image_url == canonical_id or image_url in urls:
+        return
+    urls.append(image_url)
+    col.update(
+        ids=[canonical_id],
+        metadatas=[{**meta, "duplicate_urls": json.dumps(urls), "duplicate_count": len(urls)}],
+    )
+
+
+def cluster_near_duplicates(threshold: float = None, prune: bool = False, batch_size: int = 256):
+    """
+    Cluster an existing collection by near-duplicate embeddings and assign canonical_id.
+    Neighbours come from the collection's ANN index. Records are visited in insertion order;
+    an unassigned record becomes canonical and claims the unassigned neighbours within the
+    threshold of itself, so every member is compared to the canonical and clusters cannot chain.
+    With prune=True the non-canonical copies are deleted.
+    """
+    threshold = settings.dedupe_cosine_threshold if threshold is None else threshold
+    col = get_shoe_collection()
+    if requires_migration(col):
+        print("Refusing to dedupe an unmigrated collection; run `python -m utils.db_utils --migrate` first.")
+        return {}
+    data = col.get(include=["embeddings", "metadatas"])
+    ids = data["ids"]
+    if not ids:
+        print("No records found in the collection.")
+        return {}
+    embs = np.asarray(data["embeddings"], dtype=np.float32)
+    embs = embs / np.maximum(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12)
+    metas = [m or {} for m in data["metadatas"]]
+    index = {_id: i for i, _id in enumerate(ids)}
+
+    k = min(settings.dedupe_neighbours + 1, len(ids))
+    neighbours = []
+    for start in range(0, len(ids), batch_size):
+        batch = embs[start:start + batch_size]
+        res = col.query(query_embeddings=batch.tolist(), n_results=k, include=["distances"])
+        neighbours.extend(res["ids"])
+
+    assigned = [None] * len(ids)
+    clusters = {}
+    for i in range(len(ids)):
+        if assigned[i] is not None:
+            continue
+        assigned[i] = i
+        clusters[i] = [i]
+        for nid in neighbours[i]:
+            j = index.get(nid)
+            if j is None or assigned[j] is not None or float(embs[i] @ embs[j]) < threshold:
+                continue
+            assigned[j] = i
+            clusters[i].append(j)
+
+    updated_ids, updated_metas, to_delete = [], [], []
+    for root, members in clusters.items():
+        canonical = ids[root]
+        own_url = metas[root].get("image_url", canonical)
+        copies = []
+        for i in members:
+            recorded = json.loads(metas[i].get("duplicate_urls") or "[]")
+            candidates = recorded if i == root else [metas[i].get("image_url", ids[i])] + recorded
+            copies.extend(u for u in candidates if u != own_url and u not in copies)
+        for i in members:
+            meta = {**metas[i], "canonical_id": canonical}
+            if i == root:
+                meta["duplicate_urls"] = json.dumps(copies)
+                meta["duplicate_count"] = len(copies)
+            elif prune:
+                to_delete.append(ids[i])
+                continue
+            if meta != metas[i]:
+                updated_ids.append(ids[i])
+                updated_metas.append(meta)
+
+    for start in range(0, len(updated_ids), batch_size):
+        col.update(ids=updated_ids[start:start + batch_size], metadatas=updated_metas[start:start + batch_size])
+    if to_delete:
+        col.delete(ids=to_delete)
+    dup_clusters = sum(1 for members in clusters.values() if len(members) > 1)
+    print(f"Done. records={len(ids)}, products={len(clusters)}, duplicate_clusters={dup_clusters}, deleted={len(to_delete)}")
+    return {ids[root]: [ids[i] for i in members] for root, members in clusters.items()}
+
+
 def guess_brand(url: str):
     u = url.lower()
     if "beymen" in u: return "Beymen"
@@ -75,12 +196,18 @@ def guess_brand(url: str):
     if "lacoste" in u: return "Lacoste"
     return "Premium"
 
-def image_to_json_and_caption(image_url: str):
-    if azure_client is None:
+def image_to_json_and_caption(image_url: str, stats: dict = None):
+    """Caption a product photo; if stats is given it is filled with bytes sent and tokens used."""
+    if not gateway.available:
         return {}, ""  # fallback
-    b64 = get_base64_image_from_url(image_url)
-    if not b64:
+    payload = prepare_image_payload(image_url)
+    if not payload:
         return {}, ""  # fallback
+    if stats is not None:
+        stats.update(
+            original_bytes=payload["original_bytes"], bytes=payload["bytes"],
+            detail=payload["detail"], image_tokens=payload["estimated_tokens"],
+        )
     msgs = [
         {
             "role": "system",
@@ -90,14 +217,18 @@ def image_to_json_and_caption(image_url: str):
             "role": "user",
             "content": [
                 {"type": "text", "text": "Analyze this shoe image."},
-                {"type": "image_url", "image_url": {"url": b64}},
+                {"type": "image_url", "image_url": {"url": payload["url"], "detail": payload["detail"]}},
             ],
         },
     ]
     try:
-        r = azure_client.chat.completions.create(
-            model="gpt-4o", messages=msgs, max_tokens=600, temperature=0
+        r = gateway.chat(
+            priority=BATCH,
+            estimated_tokens=estimate_tokens(msgs, 600, image_tokens=payload["estimated_tokens"]),
+            model="gpt-4o", messages=msgs, max_tokens=600, temperature=0,
         )
+        if stats is not None and getattr(r, "usage", None) is not None:
+            stats.update(prompt_tokens=r.usage.prompt_tokens, completion_tokens=r.usage.completion_tokens)
         data = json.loads(r.choices[0].message.content)
         return data.get("json", {}), data.get("caption", "")
     except Exception as e:
@@ -107,19 +238,47 @@ def image_to_json_and_caption(image_url: str):
 
 def process_images_to_json_and_insert(image_links: list[str]):
     print(f"Processing {len(image_links)} images...")
-    ok, fail = 0, 0
+    col = get_shoe_collection()
+    if requires_migration(col):
+        print("Refusing to index into an unmigrated collection; run `python -m utils.db_utils --migrate` first.")
+        return
+    ok, dup, fail = 0, 0, 0
+    totals = {"original_bytes": 0, "bytes": 0, "image_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0}
     for url in image_links:
         try:
-            jd, caption = image_to_json_and_caption(url)
+            if col.get(ids=[url])["ids"]:
+                print(f"already indexed: {url}")
+                continue
+            emb = get_clip_image_embedding(url)
+            match = find_near_duplicate(col, emb)
+            if match:
+                canonical_id, meta = match
+                register_duplicate(col, canonical_id, meta, url)
+                dup += 1
+                print(f"duplicate: {url} -> {canonical_id}")
+                continue
+            stats = {}
+            jd, caption = image_to_json_and_caption(url, stats)
             if not jd: jd = {}
             if not caption: caption = f"{guess_brand(url)} ayakkabı"
-            insert_to_vector_db(url, jd, caption)
+            insert_to_vector_db(url, jd, caption, emb=emb)
             ok += 1
-            print(f"added: {url}")
+            for k in totals:
+                totals[k] += stats.get(k, 0)
+            print(
+                f"added: {url} | {stats.get('original_bytes', 0) // 1024}KB -> {stats.get('bytes', 0) // 1024}KB"
+                f" ({stats.get('detail', '-')}) | tokens image~{stats.get('image_tokens', 0)}"
+                f" prompt={stats.get('prompt_tokens', 0)}"
+                f" completion={stats.get('completion_tokens', 0)}"
+            )
         except Exception as e:
             fail += 1
             print(f"skip: {url} - {e}")
-    print(f"Done. added={ok}, failed={fail}")
+    print(f"Done. added={ok}, duplicates={dup}, failed={fail}")
+    print(
+        f"Payload: {totals['original_bytes'] // 1024}KB original -> {totals['bytes'] // 1024}KB sent | "
+        f"tokens image~{totals['image_tokens']} prompt={totals['prompt_tokens']} completion={totals['completion_tokens']}"
+    )
 
 
 def _norm_txt(t: str) -> str:
@@ -144,13 +303,44 @@ def _meta_score(tokens: set[str], blob: str) -> float:
     hits = sum(1 for t in tokens if t in blob)
     return hits / max(1, len(tokens))
 
-def _vec_score_from_distance(d: float) -> float:
+def _vec_score_from_distance(d: float, space: str = None) -> float:
+    """
+    Map a Chroma distance to a [0,1] similarity for the collection's space, assuming
+    unit-normalised embeddings: cosine/ip return 1 - cos, l2 returns squared L2 = 2 - 2cos.
+    The cosine is then rescaled from [vector_score_cos_low, vector_score_cos_high] to [0,1]
+    so the vector term spreads as much as the metadata score does.
+    """
+    space = space or settings.vector_space
     try:
-        s = 1.0 - float(d)
-        return max(0.0, min(1.0, s))
+        d = float(d)
+        cos = 1.0 - d / 2.0 if space == "l2" else 1.0 - d
+        lo, hi = settings.vector_score_cos_low, settings.vector_score_cos_high
+        return max(0.0, min(1.0, (cos - lo) / max(hi - lo, 1e-6)))
     except Exception:
         return 0.0
 
+def _collapse_duplicates(ranked: list, top_k: int) -> list:
+    """
+    Keep the best-scoring hit per product: same canonical_id. Records indexed before
+    canonical_id existed carry their embedding and are collapsed by cosine similarity
+    among themselves; records with a canonical_id are never re-clustered here.
+    """
+    kept, seen = [], set()
+    for row in ranked:
+        _id, m, e = row[4], row[5], row[7]
+        key = m.get("canonical_id") or _id
+        if key in seen:
+            continue
+        if e is not None and any(
+            k[7] is not None and _cosine(e, k[7]) >= settings.dedupe_cosine_threshold for k in kept
+        ):
+            continue
+        seen.add(key)
+        kept.append(row)
+        if len(kept) == top_k:
+            break
+    return kept
+
 def vector_search_shoes(query: str, top_k: int = 5, weight_vector: float = 0.5):
     try:
         col = get_shoe_collection()
@@ -158,32 +348,39 @@ def vector_search_shoes(query: str, top_k: int = 5, weight_vector: float = 0.5):
         emb = get_clip_text_embedding(q)
         res = col.query(
             query_embeddings=[emb],
-            n_results=max(top_k * 8, top_k),
-            include=["metadatas", "documents", "distances", "ids"],
+            n_results=max(top_k * settings.search_overfetch, top_k),
+            include=["metadatas", "documents", "distances"],
         )
 
         docs  = res.get("documents", [[]])[0]
         metas = res.get("metadatas", [[]])[0]
         dists = res.get("distances", [[]])[0]
         ids   = res.get("ids", [[]])[0]
+        legacy = [_id for _id, m in zip(ids, metas) if not (m or {}).get("canonical_id")]
+        legacy_embs = {}
+        if legacy:
+            got = col.get(ids=legacy, include=["embeddings"])
+            legacy_embs = dict(zip(got["ids"], got["embeddings"]))
+        embs  = [legacy_embs.get(_id) for _id in ids]
         if not docs:
             return "🔍 Veritabanımızda bu kriterlere uygun ayakkabı bulunamadı."
 
+        space = (col.metadata or {}).get("hnsw:space", "l2")
         tokens = _query_tokens(query)
         wv = max(0.0, min(1.0, weight_vector))
         wm = 1.0 - wv
 
         scored = []
-        for d, _id, m, doc in zip(dists, ids, metas, docs):
-            vs = _vec_score_from_distance(d)
+        for d, _id, m, doc, e in zip(dists, ids, metas, docs, embs):
+            vs = _vec_score_from_distance(d, space)
             ms = _meta_score(tokens, _meta_blob(m or {}, doc))
             final = wv * vs + wm * ms
-            scored.append((final, vs, ms, d, _id, m or {}, doc))
+            scored.append((final, vs, ms, d, _id, m or {}, doc, e))
 
-        ranked = sorted(scored, key=lambda x: (-x[0], str(x[4])))[:top_k]
+        ranked = _collapse_duplicates(sorted(scored, key=lambda x: (-x[0], str(x[4]))), top_k)
 
         out = []
-        for final, vs, ms, dist, _id, m, doc in ranked:
+        for final, vs, ms, dist, _id, m, doc, _ in ranked:
             name = m.get("name") or create_realistic_shoe_name(m)
             desc = (m.get("description") or doc) or ""
             attrs = build_shoe_attributes(m)
@@ -254,7 +451,7 @@ def get_current_weather(city: str):
     try:
         if getattr(settings, "accuwather_key", None):
             loc = requests.get(
-                f"http://dataservice.accuweather.com/locations/v1/cities/search",
+                f"{settings.accuweather_base_url}/locations/v1/cities/search",
                 params={"apikey": settings.accuwather_key, "q": city, "language": "tr-tr"},
                 timeout=8,
             )
@@ -263,7 +460,7 @@ def get_current_weather(city: str):
             if items:
                 key = items[0]["Key"]
                 w = requests.get(
-                    f"http://dataservice.accuweather.com/currentconditions/v1/{key}",
+                    f"{settings.accuweather_base_url}/currentconditions/v1/{key}",
                     params={"apikey": settings.accuwather_key, "language": "tr-tr", "details": "true"},
                     timeout=8,
                 )
@@ -272,7 +469,7 @@ def get_current_weather(city: str):
                 return f"{city}: {cur['WeatherText']}, {cur['Temperature']['Metric']['Value']}°C (Hissedilen {cur['RealFeelTemperature']['Metric']['Value']}°C)"
         if getattr(settings, "weather_api_key", None):
             w = requests.get(
-                "http://api.openweathermap.org/data/2.5/weather",
+                f"{settings.openweather_base_url}/data/2.5/weather",
                 params={"q": city, "appid": settings.weather_api_key, "units": "metric", "lang": "tr"},
                 timeout=8,
             )